@@ -1,7 +1,17 @@
+import asyncio
+import functools
+import hashlib
+import jwt
 import logging
 import msal
 import os
+import secrets
+import time
 
+from cachetools import TTLCache
+from collections import deque
+from collections.abc import AsyncIterator
+from dataclasses import dataclass
 from a2a.server.agent_execution import AgentExecutor, RequestContext
 from a2a.server.events import EventQueue
 from a2a.server.tasks import TaskUpdater
@@ -20,82 +30,226 @@ from microsoft_agents.copilotstudio.client import (
     ConnectionSettings,
     CopilotClient,
 )
-import uuid
 
 logger = logging.getLogger(__name__)
 
+
+@dataclass(frozen=True, slots=True)
+class _CpsConfig:
+    """Copilot Studio connection settings, read once from the environment."""
+    env_id: str | None
+    schema: str | None
+    app_id: str | None
+    tenant: str | None
+    secret: str | None
+
+
+_CFG = _CpsConfig(
+    env_id=os.environ.get("COPILOTSTUDIOAGENT__ENVIRONMENTID"),
+    schema=os.environ.get("COPILOTSTUDIOAGENT__SCHEMANAME"),
+    app_id=os.environ.get("COPILOTSTUDIOAGENT__AGENTAPPID"),
+    tenant=os.environ.get("COPILOTSTUDIOAGENT__TENANTID"),
+    secret=os.environ.get("COPILOTSTUDIOAGENT__CLIENTSECRET"),
+)
+_AUTHORITY = f"https://login.microsoftonline.com/{_CFG.tenant}"
+
+COPILOT_SCOPES = ["https://api.powerplatform.com/.default"]
+
+# bounds on per-conversation state kept in memory
+MAX_THREADS = 10_000
+THREAD_TTL = 3600
+MAX_THREAD_MESSAGES = 50
+
+# how long to wait for follow-up messages before sending a turn to Copilot Studio
+BATCH_WINDOW = 0.05
+
+# treat Copilot Studio tokens as expired this many seconds early
+COPILOT_TOKEN_LEEWAY = 60
+
+# user token hash -> (copilot access token, expires_on)
+_copilot_tokens: dict[str, tuple[str, float]] = {}
+# user token hash -> lock held while exchanging that token
+_copilot_token_locks: dict[str, asyncio.Lock] = {}
+
+
+@functools.lru_cache(maxsize=None)
+def _get_cca(authority: str, app_id: str, secret: str) -> msal.ConfidentialClientApplication:
+    """Get the shared confidential client for the given app registration."""
+    return msal.ConfidentialClientApplication(
+        app_id,
+        authority=authority,
+        client_credential=secret
+    )
+
+
+def _prune_copilot_tokens(now: float):
+    """Drop expired tokens and the locks of user tokens that are no longer cached."""
+    for key in [k for k, (_, expires_on) in _copilot_tokens.items() if expires_on <= now]:
+        del _copilot_tokens[key]
+    for key in [k for k, lock in _copilot_token_locks.items() if k not in _copilot_tokens and not lock.locked()]:
+        del _copilot_token_locks[key]
+
+
+async def _acquire_copilot_token(access_token: str) -> tuple[str, float]:
+    """Exchange the user's access token for a Copilot Studio token and its expiry, reusing cached tokens."""
+    user_assertion_hash = hashlib.sha256(access_token.encode()).hexdigest()
+    cached = _copilot_tokens.get(user_assertion_hash)
+    if cached and cached[1] - COPILOT_TOKEN_LEEWAY > time.time():
+        return cached
+
+    async with _copilot_token_locks.setdefault(user_assertion_hash, asyncio.Lock()):
+        # another request for the same user token may have refreshed it while we waited
+        cached = _copilot_tokens.get(user_assertion_hash)
+        if cached and cached[1] - COPILOT_TOKEN_LEEWAY > time.time():
+            return cached
+
+        confidentialcredential = _get_cca(_AUTHORITY, _CFG.app_id, _CFG.secret)
+        logger.info("Acquiring Copilot Studio token on behalf of users access token...")
+        copilottoken = await asyncio.to_thread(
+            confidentialcredential.acquire_token_on_behalf_of,
+            user_assertion=access_token,
+            scopes=COPILOT_SCOPES
+        )
+        logger.debug("Acquired Copilot Studio token, expires_in=%s", copilottoken.get("expires_in"))
+        if "access_token" not in copilottoken:
+            raise RuntimeError(
+                f"Unable to acquire Copilot Studio token: {copilottoken.get('error_description', copilottoken.get('error'))}"
+            )
+
+        now = time.time()
+        _prune_copilot_tokens(now)
+        cached = _copilot_tokens[user_assertion_hash] = (
+            copilottoken["access_token"],
+            now + int(copilottoken.get("expires_in", 0))
+        )
+        return cached
+
+
+def _user_key(access_token: str | None) -> str:
+    """Identify the caller behind a token, stable across their token refreshes.
+
+    Tokens reaching the executor were already validated by OAuthMiddleware, so the
+    claims are read here without checking the signature again.
+    """
+    if not access_token:
+        return ''
+    try:
+        claims = jwt.decode(access_token, options={"verify_signature": False})
+    except jwt.InvalidTokenError:
+        claims = {}
+    oid = claims.get('oid') or claims.get('sub')
+    if oid:
+        return f"{claims.get('tid', '')}:{oid}"
+    return hashlib.sha256(access_token.encode()).hexdigest()
+
+
+def _extract_bearer(context: RequestContext) -> str | None:
+    """Get the bearer token from the Authorization header of the inbound request."""
+    state = getattr(getattr(context, 'call_context', None), 'state', None)
+    if not state:
+        return None
+    auth_header = state.get("headers", {}).get("authorization", "")
+    if not auth_header.startswith("Bearer "):
+        return None
+    logger.debug("Extracted access token from Authorization header.")
+    return auth_header[7:] or None
+
+
 class GenericThread():
-    def __init__(self, id=uuid.uuid4()):
-        self.id = id
-        self.messages = [] # list of strings
+    __slots__ = ('id', 'messages')
+
+    def __init__(self, id: str | None = None):
+        self.id = id or secrets.token_hex(16)
+        self.messages = deque(maxlen=MAX_THREAD_MESSAGES) # most recent strings
+
+@dataclass(slots=True)
+class _PendingMessage:
+    """A user message waiting for its context's dispatcher."""
+    text: str
+    task_updater: TaskUpdater
+    access_token: str
+    done: asyncio.Future
+
 
 class CopilotStudioAgent:
     """Copilot Studio Agent."""
 
     def __init__(self, access_token: str):
-        self.threads = {}
+        self.threads = TTLCache(maxsize=MAX_THREADS, ttl=THREAD_TTL)
         self.access_token = access_token
+        self._clients: TTLCache[str, tuple[CopilotClient, str, float]] = TTLCache(
+            maxsize=MAX_THREADS, ttl=THREAD_TTL
+        )  # thread_id -> (client, conversation_id, token expires_on)
+
+    async def aclose(self):
+        """Drop the cached Copilot Studio clients and all threads."""
+        self._clients.clear()
+        self.threads.clear()
 
     async def create_thread(self):
-        thread = GenericThread()
+        session = await self._start_conversation(self.access_token)
+        # the Copilot Studio conversation id doubles as the thread id
+        thread = GenericThread(id=session[1])
         self.threads[thread.id] = thread
+        self._clients[thread.id] = session
         return thread
 
-    async def run_conversation(self, thread_id: str, user_message: str) -> list[str]:
-        # For demo purposes, just echo the message back with a prefix
-        response = await self.invoke(user_message, self.access_token)
-        logging.info(f'Agent received message: {user_message} in thread {thread_id}')
-        logging.info(f'Agent responding with: {response} in thread {thread_id}')
-        if thread_id not in self.threads:
-            logger.warning(f'Thread ID {thread_id} not found. Creating new thread.')
-            gt = GenericThread(id=thread_id)
-            self.threads[thread_id] = gt
-
-        self.threads[thread_id].messages.append(user_message)
-        self.threads[thread_id].messages.append(response)
-        return self.threads[thread_id].messages
-
-    async def create_client(self, access_token):
+    async def create_client(self, access_token) -> tuple[CopilotClient, float]:
         settings = ConnectionSettings(
-            environment_id=os.environ.get("COPILOTSTUDIOAGENT__ENVIRONMENTID"),
-            agent_identifier=os.environ.get("COPILOTSTUDIOAGENT__SCHEMANAME"),
+            environment_id=_CFG.env_id,
+            agent_identifier=_CFG.schema,
             cloud=None,
             copilot_agent_type=None,
             custom_power_platform_cloud=None,
         )
-        logger.info(f"Configuring settings...")
-        confidentialcredential = msal.ConfidentialClientApplication(
-            os.environ.get("COPILOTSTUDIOAGENT__AGENTAPPID"),
-            authority=f"https://login.microsoftonline.com/{os.environ.get('COPILOTSTUDIOAGENT__TENANTID')}",
-            client_credential=os.environ.get("COPILOTSTUDIOAGENT__CLIENTSECRET")
-        )
-        logger.info(f"Acquiring Copilot Studio token on behalf of users access token...")
-        copilottoken = confidentialcredential.acquire_token_on_behalf_of(
-            user_assertion=access_token,
-            scopes=["https://api.powerplatform.com/.default"]
-        )
-        logger.debug(f"Acquired Copilot Studio token: {copilottoken}")
-
-        copilot_client = CopilotClient(settings, copilottoken["access_token"])
-        return copilot_client
-    
-    async def invoke(self, text: str, access_token: str) -> str:
-        print(f'CopilotStudioAgent received input: {text}')
-        copilot_client =await self.create_client(access_token)
+        logger.info("Configuring settings...")
+        copilottoken, expires_on = await _acquire_copilot_token(access_token)
+
+        copilot_client = CopilotClient(settings, copilottoken)
+        return copilot_client, expires_on
+
+    async def _start_conversation(self, access_token: str) -> tuple[CopilotClient, str, float]:
+        """Create a client and start a new Copilot Studio conversation."""
+        copilot_client, expires_on = await self.create_client(access_token)
         act = copilot_client.start_conversation(True)
         logger.info("Starting conversation...")
+        conversation_id = None
         async for action in act:
             if action.text:
                 logger.info(action.text)
+            if action.conversation:
                 conversation_id = action.conversation.id
-        logger.info(f"Conversation ID: {conversation_id}")
+        logger.info("Conversation ID: %s", conversation_id)
+        return copilot_client, conversation_id, expires_on
+
+    async def _bootstrap(self, thread_id: str, access_token: str) -> tuple[CopilotClient, str, float]:
+        """Start a conversation for a thread we have no client for yet."""
+        session = await self._start_conversation(access_token)
+        self._clients[thread_id] = session
+        return session
+
+    async def invoke(self, text: str, access_token: str, thread_id: str) -> AsyncIterator[str]:
+        logger.debug('CopilotStudioAgent received input: %s', text)
+        thread = self.threads.get(thread_id)
+        if thread is None:
+            logger.warning('Thread ID %s not found. Creating new thread.', thread_id)
+            thread = GenericThread(id=thread_id)
+        # re-insert on every turn so THREAD_TTL acts as an idle timeout
+        self.threads[thread_id] = thread
+        messages = thread.messages
+        messages.append(text)
+
+        copilot_client, conversation_id, expires_on = self._clients.get(thread_id) or await self._bootstrap(thread_id, access_token)
+        if expires_on - COPILOT_TOKEN_LEEWAY <= time.time():
+            # the client's token is about to expire, carry on the conversation with a fresh one
+            copilot_client, expires_on = await self.create_client(access_token)
+        self._clients[thread_id] = (copilot_client, conversation_id, expires_on)
         replies = copilot_client.ask_question(text, conversation_id)
         async for reply in replies:
-            if reply.type == ActivityTypes.message:
-                logger.info(f"Received reply: {reply.text}")
-                return reply.text
-
-        #return f'Copilot Studio: {text}'
+            if reply.type == ActivityTypes.message and reply.text:
+                logger.info("Received reply: %s", reply.text)
+                messages.append(reply.text)
+                yield reply.text
 
 
 class GenericAgentExecutor(AgentExecutor):
@@ -105,31 +259,42 @@ class GenericAgentExecutor(AgentExecutor):
 
     def __init__(self, card: AgentCard):
         self._card = card
-        self._agent: CopilotStudioAgent | None = None
-        self._active_threads: dict[
-            str, str
-        ] = {}  # context_id -> thread_id mapping
-        self.access_token = None
-
-    async def _get_or_create_agent(self, access_token: str) -> CopilotStudioAgent:
-        """Get or create the Copilot Studio agent."""
-        if not self._agent or self.access_token != access_token:
-            logging.info("Creating new Copilot Studio agent instance...")
-            self.access_token = access_token
-            self._agent = CopilotStudioAgent(access_token)
-        return self._agent
-
-    async def _get_or_create_thread(self, context_id: str, access_token: str) -> str:
+        self._agents: TTLCache[str, CopilotStudioAgent] = TTLCache(
+            maxsize=MAX_THREADS, ttl=THREAD_TTL
+        )  # user key -> agent holding that user's Copilot Studio sessions
+        self._active_threads: TTLCache[str, str] = TTLCache(
+            maxsize=MAX_THREADS, ttl=THREAD_TTL
+        )  # context_id -> thread_id mapping
+        self._pending: dict[str, asyncio.Queue] = {}  # context_id -> queued messages
+        self._dispatchers: set[asyncio.Task] = set()
+        self._cleanup_lock = asyncio.Lock()
+
+    def _get_or_create_agent(self, access_token: str) -> CopilotStudioAgent:
+        """Get or create the Copilot Studio agent for the caller of a request."""
+        user_key = _user_key(access_token)
+        agent = self._agents.get(user_key)
+        if agent is None:
+            logger.info("Creating new Copilot Studio agent instance...")
+            agent = CopilotStudioAgent(access_token)
+        # pick up the caller's refreshed token, and re-insert so THREAD_TTL acts as an idle timeout
+        agent.access_token = access_token
+        self._agents[user_key] = agent
+        return agent
+
+    async def _get_or_create_thread(self, context_id: str, agent: CopilotStudioAgent) -> str:
         """Get or create a thread for the given context."""
-        if context_id not in self._active_threads:
-            agent = await self._get_or_create_agent(access_token)
+        # read once, entries can expire between lookups
+        thread_id = self._active_threads.get(context_id)
+        if thread_id is None:
             thread = await agent.create_thread()
-            self._active_threads[context_id] = thread.id
+            thread_id = thread.id
             logger.info(
-                f'Created new thread {thread.id} for context {context_id}'
+                'Created new thread %s for context %s', thread.id, context_id
             )
 
-        return self._active_threads[context_id]
+        # re-insert on every use so THREAD_TTL acts as an idle timeout
+        self._active_threads[context_id] = thread_id
+        return thread_id
 
     async def _process_request(
         self,
@@ -138,15 +303,11 @@ class GenericAgentExecutor(AgentExecutor):
         task_updater: TaskUpdater,
         access_token: str
     ) -> None:
-        """Process a user request through the Foundry agent."""
+        """Queue a user request for the context's dispatcher and wait for it to be answered."""
         try:
             # Convert A2A parts to text message
             user_message = self._convert_parts_to_text(message_parts)
 
-            # Get agent and thread
-            agent = await self._get_or_create_agent(access_token)
-            thread_id = await self._get_or_create_thread(context_id, access_token)
-
             # Update status
             await task_updater.update_status(
                 TaskState.working,
@@ -154,34 +315,114 @@ class GenericAgentExecutor(AgentExecutor):
                     'Processing your request...', context_id=context_id
                 ),
             )
-
-            # Run the conversation
-            responses = await agent.run_conversation(thread_id, user_message)
-
-            # Send responses back
-            for response in responses:
-                await task_updater.update_status(
-                    TaskState.working,
-                    message=new_agent_text_message(
-                        response, context_id=context_id
-                    ),
+        except Exception as e:
+            logger.error('Error processing request: %s', e, exc_info=True)
+            await task_updater.failed(
+                message=new_agent_text_message(
+                    f'Error: {e!s}', context_id=context_id
                 )
+            )
+            return
+
+        pending = _PendingMessage(
+            user_message, task_updater, access_token, asyncio.get_running_loop().create_future()
+        )
+        queue = self._pending.get(context_id)
+        if queue is None:
+            queue = self._pending[context_id] = asyncio.Queue()
+            dispatcher = asyncio.create_task(self._dispatch(context_id, queue))
+            self._dispatchers.add(dispatcher)
+            dispatcher.add_done_callback(self._dispatchers.discard)
+        queue.put_nowait(pending)
+        await pending.done
+
+    async def _dispatch(self, context_id: str, queue: asyncio.Queue) -> None:
+        """Drain a context's queue, merging consecutive text messages into one Copilot Studio turn."""
+        held = None
+        try:
+            while held is not None or not queue.empty():
+                batch = [held or queue.get_nowait()]
+                held = None
+                # the task waiting on this message was cancelled
+                if batch[0].done.cancelled():
+                    continue
+                # commands are never merged with other messages
+                if not batch[0].text.startswith('/'):
+                    await asyncio.sleep(BATCH_WINDOW)
+                    while not queue.empty():
+                        pending = queue.get_nowait()
+                        if pending.done.cancelled():
+                            continue
+                        # never merge commands, or messages sent with another bearer token
+                        if pending.text.startswith('/') or pending.access_token != batch[0].access_token:
+                            held = pending
+                            break
+                        batch.append(pending)
+                # tasks may also have been cancelled while we waited for follow-ups
+                batch = [pending for pending in batch if not pending.done.cancelled()]
+                if batch:
+                    await self._run_batch(context_id, batch)
+        finally:
+            if self._pending.get(context_id) is queue:
+                del self._pending[context_id]
+            leftovers = [held] if held else []
+            while not queue.empty():
+                leftovers.append(queue.get_nowait())
+            for pending in leftovers:
+                pending.done.cancel()
+
+    async def _run_batch(self, context_id: str, batch: list['_PendingMessage']) -> None:
+        """Send a batch of messages to the Copilot Studio agent and answer every task in it."""
+        user_message = '\n'.join(pending.text for pending in batch)
+        access_token = batch[0].access_token
+        if len(batch) > 1:
+            logger.info('Merged %d messages for context %s', len(batch), context_id)
+        try:
+            # Get agent and thread
+            agent = self._get_or_create_agent(access_token)
+            thread_id = await self._get_or_create_thread(context_id, agent)
+
+            # Stream replies back as they arrive
+            final_message = None
+            async for chunk in agent.invoke(user_message, access_token, thread_id):
+                live = [pending for pending in batch if not pending.done.cancelled()]
+                if not live:
+                    # every task in the batch was cancelled, stop the Copilot Studio call
+                    break
+                for pending in live:
+                    await pending.task_updater.update_status(
+                        TaskState.working,
+                        message=new_agent_text_message(
+                            chunk, context_id=context_id
+                        ),
+                    )
+                final_message = chunk
 
             # Mark as complete
-            final_message = responses[-1] if responses else 'Task completed.'
-            await task_updater.complete(
-                message=new_agent_text_message(
-                    final_message, context_id=context_id
+            final_message = final_message or 'Task completed.'
+            for pending in batch:
+                if pending.done.cancelled():
+                    continue
+                await pending.task_updater.complete(
+                    message=new_agent_text_message(
+                        final_message, context_id=context_id
+                    )
                 )
-            )
 
         except Exception as e:
-            logger.error(f'Error processing request: {e}', exc_info=True)
-            await task_updater.failed(
-                message=new_agent_text_message(
-                    f'Error: {e!s}', context_id=context_id
+            logger.error('Error processing request: %s', e, exc_info=True)
+            for pending in batch:
+                if pending.done.cancelled():
+                    continue
+                await pending.task_updater.failed(
+                    message=new_agent_text_message(
+                        f'Error: {e!s}', context_id=context_id
+                    )
                 )
-            )
+        finally:
+            for pending in batch:
+                if not pending.done.done():
+                    pending.done.set_result(None)
 
     def _convert_parts_to_text(self, parts: list[Part]) -> str:
         """Convert A2A message parts to a text string."""
@@ -198,7 +439,7 @@ class GenericAgentExecutor(AgentExecutor):
                 elif isinstance(part.file, FileWithBytes):
                     text_parts.append(f'[File: {len(part.file.bytes)} bytes]')
             else:
-                logger.warning(f'Unsupported part type: {type(part)}')
+                logger.warning('Unsupported part type: %s', type(part))
 
         return ' '.join(text_parts)
 
@@ -208,21 +449,9 @@ class GenericAgentExecutor(AgentExecutor):
         event_queue: EventQueue,
     ):
         """Execute the agent request."""
-        logger.info(f'Executing request for context: {context.context_id}')
-
-        access_token = None
-
-        if hasattr(context, 'call_context'):
-            logger.info(f"Context has call_context attribute.")
-            if hasattr(context.call_context, 'state'):
-                logger.info(f"Context has call_context.state attribute.")
-                logger.info(f"Call context state: {context.call_context.state}")
-                headers = context.call_context.state.get("headers", {})
-                logger.info(f"Extracted headers from call context state: {headers}")
-                auth_header = headers.get("authorization", "")
-                if auth_header.startswith("Bearer "):
-                    access_token = auth_header.split(" ")[1]
-                    logger.info(f"Extracted access token from Authorization header.")
+        logger.info('Executing request for context: %s', context.context_id)
+
+        access_token = _extract_bearer(context)
 
         # Create task updater
         updater = TaskUpdater(event_queue, context.task_id, context.context_id)
@@ -243,12 +472,12 @@ class GenericAgentExecutor(AgentExecutor):
         )
 
         logger.debug(
-            f'Foundry agent execution completed for {context.context_id}'
+            'Foundry agent execution completed for %s', context.context_id
         )
 
     async def cancel(self, context: RequestContext, event_queue: EventQueue):
         """Cancel the ongoing execution."""
-        logger.info(f'Cancelling execution for context: {context.context_id}')
+        logger.info('Cancelling execution for context: %s', context.context_id)
 
         # For now, just log cancellation
         # In a full implementation, you might want to:
@@ -265,11 +494,24 @@ class GenericAgentExecutor(AgentExecutor):
 
     async def cleanup(self):
         """Clean up resources."""
-        if self._foundry_agent:
-            await self._foundry_agent.cleanup_agent()
-            self._foundry_agent = None
-        self._active_threads.clear()
-        logger.info('Foundry agent executor cleaned up')
+        async with self._cleanup_lock:
+            dispatchers = list(self._dispatchers)
+            for dispatcher in dispatchers:
+                dispatcher.cancel()
+            await asyncio.gather(*dispatchers, return_exceptions=True)
+            # dispatchers cancelled before they started never ran their finally block
+            for queue in self._pending.values():
+                while not queue.empty():
+                    queue.get_nowait().done.cancel()
+            self._pending.clear()
+            for agent in list(self._agents.values()):
+                await agent.aclose()
+            self._agents.clear()
+            self._active_threads.clear()
+            _copilot_tokens.clear()
+            _copilot_token_locks.clear()
+            _get_cca.cache_clear()
+        logger.info('Copilot Studio agent executor cleaned up')
 
 
 def create_generic_agent_executor(card: AgentCard) -> GenericAgentExecutor:
@@ -1,16 +1,22 @@
+import abc
+import asyncio
+import contextlib
+import hashlib
+import hmac
 import time
-import json
 import logging
 import os
+import httpx
 import jwt
-import requests
+import orjson
 import uvicorn
 
-from cryptography.hazmat.primitives import serialization
+from collections import OrderedDict
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
 from starlette.applications import Starlette
-from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import Response
+from starlette.types import ASGIApp, Receive, Scope, Send
 from starlette.routing import Route
 from a2a.server.apps import A2AStarletteApplication
 from a2a.server.request_handlers import DefaultRequestHandler
@@ -27,6 +33,7 @@ from a2a.types import (
 from .agent_executor import (
     create_generic_agent_executor,  # type: ignore[import-untyped]
 )
+from .task_store import RedisTaskStore
 
 logging.basicConfig(
     level=logging.INFO,
@@ -36,106 +43,201 @@ logger = logging.getLogger(__name__)
 
 tenant_id = os.getenv('COPILOTSTUDIOAGENT__TENANTID')
 client_id = os.getenv('COPILOTSTUDIOAGENT__AGENTAPPID')
+client_secret = os.getenv('COPILOTSTUDIOAGENT__CLIENTSECRET')
 
-class OAuthMiddleware(BaseHTTPMiddleware):
+class ORJSONResponse(Response):
+    """JSON response serialized with orjson."""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+# WWW-Authenticate challenge sent with 401/403 responses from OAuthMiddleware
+_WWW_AUTH = f'Bearer realm="", authorization_uri="https://login.microsoftonline.com/{tenant_id}/oauth2/authorize", client_id="{client_id}"'
+_UNAUTH_HDRS = {"WWW-Authenticate": _WWW_AUTH}
+
+
+# shared client for calls to Entra ID, closed on shutdown
+_AAD = httpx.AsyncClient(
+    http2=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+)
+
+
+# don't hit the discovery endpoint more than once a minute for unknown kids
+JWKS_REFRESH_INTERVAL = 60
+
+
+class JWKSCache:
+    """Signing keys published by Entra ID, keyed by kid."""
+
+    def __init__(self, tenant_id: str):
+        self.url = f"https://login.microsoftonline.com/{tenant_id}/discovery/keys"
+        self.jwt_keys: dict[str, RSAPublicKey] = {}
+        self._lock = asyncio.Lock()
+        self._loaded_at = 0.0
+
+    async def load(self):
+        """Fetch the current signing keys."""
+        response = await _AAD.get(self.url)
+        response.raise_for_status()
+
+        keys = orjson.loads(response.content)['keys']
+        self.jwt_keys = {k['kid']: jwt.PyJWK(k).key for k in keys}
+        self._loaded_at = time.monotonic()
+        logger.info("Loaded %d signing keys from %s", len(self.jwt_keys), self.url)
+
+    async def get(self, kid: str) -> RSAPublicKey:
+        """Get the key for kid, refreshing the key set once if it is unknown."""
+        if kid not in self.jwt_keys:
+            async with self._lock:
+                if kid not in self.jwt_keys and time.monotonic() - self._loaded_at > JWKS_REFRESH_INTERVAL:
+                    await self.load()
+        return self.jwt_keys[kid]
+
+
+jwks = JWKSCache(tenant_id)
+
+# headers carrying credentials, never written to the logs
+_REDACTED_HEADERS = frozenset({"authorization", "x-api-key"})
+
+# number of validated tokens remembered by OAuthMiddleware
+TOKEN_CACHE_SIZE = 4096
+# treat cached tokens as expired this many seconds early
+TOKEN_EXPIRY_LEEWAY = 30
+
+
+class AuthMiddleware(abc.ABC):
+    """Pure ASGI middleware base; dispatch returns a response to reject the request."""
+
+    # (method, path) pairs served without authentication
+    _SKIP = frozenset({
+        ("GET", "/.well-known/agent-card.json"),
+        ("GET", "/.well-known/agent.json"),
+    })
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and not self._skip(scope):
+            response = await self.dispatch(Request(scope, receive))
+            if response is not None:
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+    def _skip(self, scope: Scope) -> bool:
+        # CORS preflights never carry credentials
+        return scope["method"] == "OPTIONS" or (scope["method"], scope["path"]) in self._SKIP
+
+    @abc.abstractmethod
+    async def dispatch(self, request: Request) -> Response | None:
+        """Return a response to reject the request, or None to let it through."""
+
+
+class OAuthMiddleware(AuthMiddleware):
     """Middleware to check for OAuth token authentication."""
 
-    def __init__(self, app):
+    def __init__(self, app: ASGIApp):
         super().__init__(app)
-        self.jwt_keys = {}
-        response = requests.get(f"https://login.microsoftonline.com/{tenant_id}/discovery/keys")
-        
-        
-        keys = response.json()['keys']
-        for k in keys:
-            #print(k)
-            rsa_pem_key = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(k))
-            rsa_pem_key_bytes = rsa_pem_key.public_bytes(
-            encoding=serialization.Encoding.PEM, 
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-            )
-            #print(rsa_pem_key_bytes)
-            self.jwt_keys[k['kid']] = rsa_pem_key_bytes
-            #print("-------------")
-        
-    async def dispatch(self, request: Request, call_next):
-        logger.info(f"Incoming request: {request.method} {request.url.path}")
-        logger.info(f"Incoming headers: {request.headers}")
-        if (request.url.path == "/.well-known/agent-card.json" and request.method == "GET"):
-            return await call_next(request)
-        
+        self.jwks = jwks
+        # token digest -> (claims, exp), least recently used first
+        self._token_cache: OrderedDict[bytes, tuple[dict, int]] = OrderedDict()
+
+    async def dispatch(self, request: Request) -> Response | None:
+        logger.info("Incoming request: %s %s", request.method, request.url.path)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Incoming headers: %s", {
+                k: "<redacted>" if k in _REDACTED_HEADERS else v for k, v in request.headers.items()
+            })
         # Check for Authorization header
         auth_header = request.headers.get("Authorization")
 
-        # set a response header for  WWW-Authenticate with the appropriate challengeHTTP 401; Unauthorized
-
-        response_headers = {
-            "WWW-Authenticate": f'Bearer realm="", authorization_uri="https://login.microsoftonline.com/{tenant_id}/oauth2/authorize", client_id="{client_id}"'
-        }
-        
         if not auth_header or not auth_header.startswith("Bearer "):
             logger.info("Authorization header missing or does not start with 'Bearer '")
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=401,
                 content={"error": "Unauthorized", "message": "Bearer token is required in the Authorization header"},
-                headers=response_headers
+                headers=_UNAUTH_HDRS
             )
         
         token = auth_header.split(" ")[1]
-        auth_header = request.headers.get('Authorization')
+        token_digest = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        cached = self._token_cache.get(token_digest)
+        if cached and cached[1] - TOKEN_EXPIRY_LEEWAY > time.time():
+            self._token_cache.move_to_end(token_digest)
+            return None
+
         try:
-            logger.debug(f"Authorization header: {auth_header}")
-            token = auth_header.split(' ')[1]
-            print(token)
-            #print(settings.CLIENT_ID)
-            alg = jwt.get_unverified_header(token)['alg']
-            kid = jwt.get_unverified_header(token)['kid']
-            claims = jwt.decode(token,key=self.jwt_keys[kid], algorithms=[alg], audience=[client_id])
-            print(claims)
+            header = jwt.get_unverified_header(token)
+            claims = jwt.decode(token,key=await self.jwks.get(header['kid']), algorithms=[header['alg']], audience=[client_id])
             # validate the expiration, etc.
             if claims.get("aud") != client_id:
                 raise Exception("Invalid audience")
             if claims.get("exp") < int(time.time()):
                 raise Exception("Token has expired")
+            self._token_cache[token_digest] = (claims, claims["exp"])
+            if len(self._token_cache) > TOKEN_CACHE_SIZE:
+                self._token_cache.popitem(last=False)
         except Exception as e:
-            logger.error(f"Error decoding token: {e}")
-            return JSONResponse(status_code=403, content={"message": f"Error: {e}"}, headers=response_headers)
+            logger.error("Error decoding token: %s", e)
+            return ORJSONResponse(status_code=403, content={"message": f"Error: {e}"}, headers=_UNAUTH_HDRS)
         
-        return await call_next(request)
+        return None
 
-class APIKeyAuthMiddleware(BaseHTTPMiddleware):
+class APIKeyAuthMiddleware(AuthMiddleware):
     """Middleware to check for API key authentication."""
     
-    def __init__(self, app, api_key: str):
+    def __init__(self, app: ASGIApp, api_key: str):
         super().__init__(app)
         self.api_key = api_key
+        self._api_key_bytes = api_key.encode()
     
-    async def dispatch(self, request: Request, call_next):
-        # Allow access to the agent card endpoints without authentication
-        if (request.url.path == "/.well-known/agent-card.json" and request.method == "GET"):
-            return await call_next(request)
-        
+    async def dispatch(self, request: Request) -> Response | None:
         # Check for X-API-Key header
         provided_key = request.headers.get("X-API-Key")
         
         if not provided_key:
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=401,
                 content={"error": "Unauthorized", "message": "X-API-Key header is required"}
             )
         
-        if provided_key != self.api_key:
-            return JSONResponse(
+        if not hmac.compare_digest(provided_key.encode(), self._api_key_bytes):
+            return ORJSONResponse(
                 status_code=403,
                 content={"error": "Forbidden", "message": "Invalid API key"}
             )
         
-        return await call_next(request)
+        return None
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    if client_secret:
+        await jwks.load()
+    yield
+    try:
+        agent_executor = getattr(app.state, 'agent_executor', None)
+        if agent_executor is not None:
+            await agent_executor.cleanup()
+    finally:
+        try:
+            task_store = getattr(app.state, 'task_store', None)
+            if isinstance(task_store, RedisTaskStore):
+                await task_store.aclose()
+        finally:
+            await _AAD.aclose()
 
 
 port = int(os.getenv('PORT', 8000))
 url = f"https://{os.getenv('CONTAINER_APP_HOSTNAME')}/" if os.getenv('CONTAINER_APP_HOSTNAME') else f'http://localhost:{port}/'
 api_key = os.getenv('API_KEY', '')
+redis_url = os.getenv('REDIS_URL')
+task_ttl = int(os.getenv('TASK_TTL', 86400))
 
 if __name__ == '__main__':
     # --8<-- [start:AgentSkill]
@@ -177,9 +279,16 @@ if __name__ == '__main__':
 
     agent_executor = create_generic_agent_executor(public_agent_card)
 
+    # Keep tasks in Redis when configured so replicas can share them
+    if redis_url:
+        logger.info("Using Redis task store.")
+        task_store = RedisTaskStore(redis_url, ttl=task_ttl)
+    else:
+        task_store = InMemoryTaskStore()
+
     request_handler = DefaultRequestHandler(
         agent_executor=agent_executor,
-        task_store=InMemoryTaskStore(),
+        task_store=task_store,
     )
 
     server = A2AStarletteApplication(
@@ -189,16 +298,18 @@ if __name__ == '__main__':
     routes = server.routes()
 
     async def health_check(request: Request):
-        return JSONResponse(content={"status": "ok"})
+        return ORJSONResponse(content={"status": "ok"})
     
     routes.append(Route(path='/healthz', methods=['GET'], endpoint=health_check))
 
     
     # Build the app and add authentication middleware
-    app = Starlette(routes=routes)
+    app = Starlette(routes=routes, lifespan=lifespan)
+    app.state.agent_executor = agent_executor
+    app.state.task_store = task_store
     
     # Add API key authentication middleware if API_KEY is configured
-    if os.getenv('COPILOTSTUDIOAGENT__CLIENTSECRET'):
+    if client_secret:
         # If the environment variables for Copilot Studio Agent are set, we assume authentication is handled via tokens and skip API key middleware
         logger.info("Copilot Studio Agent credentials detected. Skipping API key middleware.")
         app.add_middleware(OAuthMiddleware)  # You would implement OAuthMiddleware to handle token-based authentication
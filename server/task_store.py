@@ -0,0 +1,48 @@
+import logging
+
+import redis.asyncio as redis
+
+from a2a.server.context import ServerCallContext
+from a2a.server.tasks import TaskStore
+from a2a.types import Task
+
+logger = logging.getLogger(__name__)
+
+
+class RedisTaskStore(TaskStore):
+    """A TaskStore that keeps tasks in Redis so they can be shared between replicas.
+
+    Each task is stored as a hash at task:{id} and expires ttl seconds after its last save.
+    """
+
+    def __init__(self, url: str, ttl: int = 86400):
+        self._redis = redis.from_url(url)
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(task_id: str) -> str:
+        return f'task:{task_id}'
+
+    async def save(self, task: Task, context: ServerCallContext | None = None) -> None:
+        """Save or update a task, resetting its expiry."""
+        key = self._key(task.id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={'data': task.model_dump_json()})
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+        logger.debug('Task %s saved to Redis', task.id)
+
+    async def get(self, task_id: str, context: ServerCallContext | None = None) -> Task | None:
+        """Get a task by id."""
+        data = await self._redis.hget(self._key(task_id), 'data')
+        if data is None:
+            return None
+        return Task.model_validate_json(data)
+
+    async def delete(self, task_id: str, context: ServerCallContext | None = None) -> None:
+        """Delete a task by id."""
+        await self._redis.delete(self._key(task_id))
+
+    async def aclose(self):
+        """Close the Redis connection pool."""
+        await self._redis.aclose()